@@ -1,18 +1,40 @@
+import ast
 import base64
+import io
 import os
+import queue
 import shutil
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 import cv2
 import numpy as np
+import onnxruntime as ort
 import supervision as sv
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from ultralytics import YOLO
+from PIL import Image
+
+try:
+    from turbojpeg import TJPF_BGR, TurboJPEG
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError):
+    # libjpeg-turbo is optional; OpenCV decodes everything when it's missing
+    turbo_jpeg = None
+
+# Largest accepted request body; bigger uploads are rejected with 413 before
+# they are read
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1 << 16
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
 CORS(app)
 
-# Detection thresholds
+# Detection thresholds. Boxes go through the same class-aware NMS as
+# Ultralytics' predict() (IoU 0.7), then overlapping masks of the same class
+# are merged at NMS_THRESHOLD like supervision's Detections.with_nms
+BOX_NMS_THRESHOLD = 0.7
 NMS_THRESHOLD = 0.8
 CONFIDENCE_THRESHOLD = 0.8
 
@@ -42,32 +64,95 @@ CLASS_NAME_TO_LETTER = {
     "y": "y",
 }
 
-# Class name mapping for display labels (OpenCV can't render ä/ö)
-CLASS_NAME_TO_LABEL = {
-    "a": "A",
-    "a_dot": "A!",
-    "b": "B",
-    "d": "D",
-    "e": "E",
-    "g": "G",
-    "h": "H",
-    "i": "I",
-    "j": "J",
-    "k": "K",
-    "l": "L",
-    "m": "M",
-    "n": "N",
-    "o": "O",
-    "o_dot": "O!",
-    "p": "P",
-    "r": "R",
-    "s": "S",
-    "t": "T",
-    "u": "U",
-    "v": "V",
-    "y": "Y",
+# EXIF orientation -> transform that turns the stored pixels upright.
+# cv2.imdecode applies these itself; libjpeg-turbo does not.
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ORIENTATION_TRANSFORMS = {
+    2: lambda img: cv2.flip(img, 1),
+    3: lambda img: cv2.rotate(img, cv2.ROTATE_180),
+    4: lambda img: cv2.flip(img, 0),
+    5: cv2.transpose,
+    6: lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE),
+    7: lambda img: cv2.rotate(cv2.transpose(img), cv2.ROTATE_180),
+    8: lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE),
 }
 
+# Annotated preview returned to the client
+PREVIEW_MAX_SIZE = 640
+PREVIEW_JPEG_QUALITY = 70
+
+# Maximum distance (pixels) between a mask outline and its simplified polygon
+POLYGON_EPSILON = 2.0
+
+# Mask overlay opacity, same as supervision's MaskAnnotator default
+MASK_OPACITY = 0.5
+
+# Labels are drawn on the preview, after it has been downscaled
+LABEL_ANNOTATOR = sv.LabelAnnotator(
+    text_position=sv.Position.BOTTOM_CENTER,
+    text_scale=1,
+    text_thickness=1,
+)
+
+# Ultralytics keeps at most this many detections per image
+MAX_DETECTIONS = 300
+
+# Execution providers in order of preference. Providers that the installed
+# onnxruntime build does not ship are skipped, so CPU-only hosts fall back to
+# CPUExecutionProvider. TensorRT builds an FP16 engine on first load and
+# caches it so restarts don't pay the build cost again.
+EXECUTION_PROVIDERS = [
+    (
+        "TensorrtExecutionProvider",
+        {
+            "device_id": 0,
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": os.environ.get("TRT_ENGINE_CACHE_PATH", "/tmp/trt-cache"),
+        },
+    ),
+    (
+        "CUDAExecutionProvider",
+        {
+            "device_id": 0,
+            "arena_extend_strategy": "kNextPowerOfTwo",
+            "cudnn_conv_algo_search": "EXHAUSTIVE",
+            "do_copy_in_default_stream": True,
+        },
+    ),
+    "CPUExecutionProvider",
+]
+
+
+def load_session(path, trt_options=None):
+    """
+    Create an ONNX Runtime session for the YOLO segmentation model.
+
+    ORT_INTRA_OP_THREADS overrides the CPU thread count; the default of 0
+    lets ONNX Runtime use one thread per physical core. trt_options are
+    merged into the TensorRT provider options.
+    """
+    print(f"Loading ONNX model from: {os.path.abspath(path)}")
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.intra_op_num_threads = int(os.environ.get("ORT_INTRA_OP_THREADS", "0"))
+
+    available = ort.get_available_providers()
+    providers = []
+    for provider in EXECUTION_PROVIDERS:
+        name = provider[0] if isinstance(provider, tuple) else provider
+        if name not in available:
+            continue
+        if name == "TensorrtExecutionProvider" and trt_options:
+            provider = (name, {**provider[1], **trt_options})
+        providers.append(provider)
+
+    loaded = ort.InferenceSession(path, sess_options, providers=providers)
+    print(f"Model loaded successfully. Providers: {', '.join(loaded.get_providers())}")
+    return loaded
+
+
 # Load ONNX model at startup
 # If MODEL_DOWNLOAD_URL is set, download from there (priority for production)
 # Otherwise try local paths (for development)
@@ -79,19 +164,18 @@ if model_url:
     import urllib.request
     
     # Use /tmp to avoid conflicts with Railway volume mount at ./model.onnx
-    model_path = "/tmp/model.onnx"
+    MODEL_PATH = "/tmp/model.onnx"
     
     # Download model
     try:
-        print(f"Downloading model to {model_path}...")
-        urllib.request.urlretrieve(model_url, model_path)
+        print(f"Downloading model to {MODEL_PATH}...")
+        urllib.request.urlretrieve(model_url, MODEL_PATH)
         print("Model downloaded successfully.")
     except Exception as e:
         print(f"Error downloading model: {e}")
         raise
     
-    model = YOLO(model_path, task="segment")
-    print("Model loaded successfully.")
+    session = load_session(MODEL_PATH)
 else:
     # Fallback to local paths for development
     MODEL_PATHS = [
@@ -106,9 +190,7 @@ else:
             break
 
     if MODEL_PATH:
-        print(f"Loading ONNX model from: {os.path.abspath(MODEL_PATH)}")
-        model = YOLO(MODEL_PATH, task="segment")
-        print("Model loaded successfully.")
+        session = load_session(MODEL_PATH)
     else:
         raise RuntimeError(
             "Model file not found! "
@@ -117,6 +199,491 @@ else:
             "See DEPLOYMENT.md for instructions."
         )
 
+# Ultralytics stores class names and input size in the ONNX metadata,
+# e.g. names="{0: 'a', 1: 'a_dot', ...}" and imgsz="[640, 640]"
+model_metadata = session.get_modelmeta().custom_metadata_map
+CLASS_NAMES = ast.literal_eval(model_metadata["names"])
+INPUT_HEIGHT, INPUT_WIDTH = ast.literal_eval(model_metadata["imgsz"])
+INPUT_NAME = session.get_inputs()[0].name
+OUTPUT_NAMES = [output.name for output in session.get_outputs()]
+
+# Solver letter and display label per class id, so detections map to text
+# by indexing with their class ids.
+LETTER_BY_ID = np.array([
+    CLASS_NAME_TO_LETTER.get(CLASS_NAMES[class_id], CLASS_NAMES[class_id])
+    for class_id in range(len(CLASS_NAMES))
+])
+
+# OpenCV can't render ä/ö, so labels are uppercase with "!" marking the dots
+LABEL_BY_ID = np.array([
+    letter.upper().replace("Ä", "A!").replace("Ö", "O!")
+    for letter in LETTER_BY_ID.tolist()
+])
+
+# Mask colour per class id (BGR), matching the label colours
+MASK_COLORS = np.array(
+    [sv.ColorPalette.DEFAULT.by_idx(class_id).as_bgr() for class_id in range(len(CLASS_NAMES))],
+    dtype=np.uint8,
+)
+
+# Each batch size gets its own IO binding with preallocated host and device
+# input buffers, so repeated calls reuse the same fixed-shape tensors
+# instead of allocating and copying fresh ones. Outputs stay on the device until
+# they are copied back for postprocessing.
+GPU_PROVIDERS = {"TensorrtExecutionProvider", "CUDAExecutionProvider"}
+DEVICE_TYPE = "cuda" if GPU_PROVIDERS & set(session.get_providers()) else "cpu"
+
+# Concurrent requests are coalesced into a single model call. Models exported
+# with a dynamic batch axis take up to BATCH_SIZE images per call; models
+# with a fixed batch axis (the Ultralytics default) run one image at a time.
+# A batch never holds more images than there are gunicorn threads, so the
+# default matches the --threads 4 in the Dockerfiles.
+batch_axis = session.get_inputs()[0].shape[0]
+MAX_BATCH_SIZE = batch_axis if isinstance(batch_axis, int) else int(os.environ.get("BATCH_SIZE", "4"))
+BATCH_WAIT_MS = 10
+
+# TensorRT rebuilds its engine whenever a batch falls outside the shapes it
+# was built for, which would stall the inference worker for minutes. Give
+# dynamic-batch models one profile covering every batch size up front.
+if not isinstance(batch_axis, int) and "TensorrtExecutionProvider" in session.get_providers():
+    session = load_session(MODEL_PATH, {
+        "trt_profile_min_shapes": f"{INPUT_NAME}:1x3x{INPUT_HEIGHT}x{INPUT_WIDTH}",
+        "trt_profile_opt_shapes": f"{INPUT_NAME}:1x3x{INPUT_HEIGHT}x{INPUT_WIDTH}",
+        "trt_profile_max_shapes": f"{INPUT_NAME}:{MAX_BATCH_SIZE}x3x{INPUT_HEIGHT}x{INPUT_WIDTH}",
+    })
+
+# The first calls pay for lazy initialisation (CUDA context, kernel autotuning,
+# TensorRT engine build), so a blank image is run through the model at
+# startup. Setting KEEPALIVE_SECONDS makes the worker re-run it after that
+# many idle seconds, so a GPU doesn't drop to idle clocks between uploads.
+# Off by default: it keeps the device busy for as long as the server idles.
+WARMUP_RUNS = 3
+KEEPALIVE_SECONDS = float(os.environ.get("KEEPALIVE_SECONDS", "0"))
+
+# Longest a request waits for its inference result before failing with 503
+INFERENCE_TIMEOUT_SECONDS = 60
+
+
+def read_upload(file):
+    """
+    Read an uploaded file into a bytearray in UPLOAD_CHUNK_SIZE chunks.
+
+    The buffer is allocated once at the upload's size (Werkzeug spools
+    uploads to a seekable file), so it is filled in place without growing.
+    """
+    stream = file.stream
+    size = stream.seek(0, io.SEEK_END)
+    stream.seek(0)
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    offset = 0
+    while offset < size:
+        read = stream.readinto(view[offset:offset + UPLOAD_CHUNK_SIZE])
+        if not read:
+            break
+        offset += read
+    view.release()
+    del buffer[offset:]
+    return buffer
+
+
+def exif_orientation(jpeg_bytes):
+    """
+    Read the EXIF orientation tag of a JPEG, or 1 (upright) if there is none.
+
+    Walks the marker segments before the image data and hands only the
+    EXIF (APP1) segment to Pillow, so the upload itself isn't copied.
+    """
+    offset = 2
+    while offset + 4 <= len(jpeg_bytes) and jpeg_bytes[offset] == 0xFF:
+        marker = jpeg_bytes[offset + 1]
+        if marker == 0xDA:  # start of scan: no metadata after this point
+            break
+        length = int.from_bytes(jpeg_bytes[offset + 2:offset + 4], "big")
+        if marker == 0xE1 and jpeg_bytes[offset + 4:offset + 10] == b"Exif\x00\x00":
+            exif = Image.Exif()
+            try:
+                exif.load(bytes(jpeg_bytes[offset + 4:offset + 2 + length]))
+            except Exception:
+                return 1  # corrupt EXIF: leave the image as decoded
+            return exif.get(EXIF_ORIENTATION_TAG, 1)
+        offset += 2 + length
+    return 1
+
+
+def decode_image(image_bytes):
+    """
+    Decode an uploaded image into a BGR array, or return None if it can't be decoded.
+
+    JPEGs go through libjpeg-turbo when it is installed. PNGs and anything
+    libjpeg-turbo rejects fall back to OpenCV.
+    """
+    if not image_bytes:
+        return None
+
+    if turbo_jpeg is not None and image_bytes[:3] == b"\xff\xd8\xff":
+        try:
+            image = turbo_jpeg.decode(image_bytes, pixel_format=TJPF_BGR)
+        except OSError:
+            image = None
+        if image is not None:
+            transform = EXIF_ORIENTATION_TRANSFORMS.get(exif_orientation(image_bytes))
+            return transform(image) if transform else image
+
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+
+def preprocess(image):
+    """
+    Letterbox a BGR image into a model-sized uint8 canvas.
+
+    Returns the canvas, the resize scale and the (left, top) padding so
+    predictions can be mapped back onto the original image. The canvas is
+    converted to the model's float input by run_batch, straight into the
+    bound input buffer.
+    """
+    height, width = image.shape[:2]
+    scale = min(INPUT_HEIGHT / height, INPUT_WIDTH / width)
+    new_width, new_height = round(width * scale), round(height * scale)
+    left = round((INPUT_WIDTH - new_width) / 2 - 0.1)
+    top = round((INPUT_HEIGHT - new_height) / 2 - 0.1)
+
+    canvas = np.full((INPUT_HEIGHT, INPUT_WIDTH, 3), 114, dtype=np.uint8)
+    target = canvas[top:top + new_height, left:left + new_width]
+    if (new_width, new_height) != (width, height):
+        cv2.resize(image, (new_width, new_height), dst=target, interpolation=cv2.INTER_LINEAR)
+    else:
+        target[:] = image
+    return canvas, scale, (left, top)
+
+
+def mask_polygon(box_mask, offset):
+    """
+    Outline a box-sized mask as a simplified polygon of [x, y] image pixel
+    coordinates, offset by the box's top-left corner (empty if the mask has
+    no pixels). Only the largest outline is kept, one per tile.
+    """
+    contours, _ = cv2.findContours(
+        box_mask.view(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_KCOS, offset=offset
+    )
+    if not contours:
+        return []
+    outline = max(contours, key=cv2.contourArea)
+    return cv2.approxPolyDP(outline, POLYGON_EPSILON, True).reshape(-1, 2).tolist()
+
+
+def mask_nms(box_masks, boxes, class_ids):
+    """
+    Greedy class-aware NMS on mask IoU, for detections already sorted by
+    confidence. box_masks are each detection's mask inside its (x1, y1, x2, y2)
+    box, so overlaps are only compared where two boxes intersect.
+
+    Returns the indices of the detections to keep.
+    """
+    areas = np.array([box_mask.sum() for box_mask in box_masks])
+    keep = []
+    for j, (x1, y1, x2, y2) in enumerate(boxes):
+        suppressed = False
+        for i in keep:
+            if class_ids[i] != class_ids[j]:
+                continue
+            ix1, iy1 = max(x1, boxes[i][0]), max(y1, boxes[i][1])
+            ix2, iy2 = min(x2, boxes[i][2]), min(y2, boxes[i][3])
+            if ix2 <= ix1 or iy2 <= iy1:
+                continue
+            overlap = np.count_nonzero(
+                box_masks[i][iy1 - boxes[i][1]:iy2 - boxes[i][1], ix1 - boxes[i][0]:ix2 - boxes[i][0]]
+                & box_masks[j][iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1]
+            )
+            union = areas[i] + areas[j] - overlap
+            if union and overlap / union > NMS_THRESHOLD:
+                suppressed = True
+                break
+        if not suppressed:
+            keep.append(j)
+    return np.array(keep, dtype=int)
+
+
+def postprocess(predictions, protos, scale, padding, image_shape, full_masks=False):
+    """
+    Decode raw YOLO segmentation outputs into supervision Detections.
+
+    predictions: (4 + num_classes + 32, num_anchors) boxes, class scores and mask coefficients
+    protos: (32, mask_height, mask_width) mask prototypes
+
+    Each mask is only upsampled inside its box, and its outline is stored in
+    detections.data["polygon"]. Full-image boolean masks (needed to draw the
+    overlay) are only built when full_masks is set; otherwise mask is None.
+    """
+    num_classes = len(CLASS_NAMES)
+    predictions = predictions.T
+
+    # Best class per anchor, dropping low-confidence anchors before NMS
+    class_scores = predictions[:, 4:4 + num_classes]
+    class_ids = class_scores.argmax(axis=1)
+    confidences = class_scores[np.arange(len(class_scores)), class_ids]
+    keep = confidences >= CONFIDENCE_THRESHOLD
+    predictions, class_ids, confidences = predictions[keep], class_ids[keep], confidences[keep]
+
+    # Class-aware NMS on (x, y, w, h) boxes in model input space
+    xywh = predictions[:, :4].copy()
+    xywh[:, :2] -= xywh[:, 2:] / 2
+    keep = cv2.dnn.NMSBoxesBatched(xywh, confidences, class_ids, CONFIDENCE_THRESHOLD, BOX_NMS_THRESHOLD)
+    keep = np.asarray(keep, dtype=int).reshape(-1)[:MAX_DETECTIONS]
+    predictions, class_ids, confidences = predictions[keep], class_ids[keep], confidences[keep]
+
+    # Map boxes back onto the original image
+    height, width = image_shape[:2]
+    left, top = padding
+    xyxy = np.empty((len(predictions), 4), dtype=np.float32)
+    xyxy[:, :2] = xywh[keep, :2]
+    xyxy[:, 2:] = xywh[keep, :2] + xywh[keep, 2:]
+    xyxy -= (left, top, left, top)
+    xyxy /= scale
+    xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, width)
+    xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, height)
+
+    # Masks: combine prototypes and strip the letterbox padding
+    num_protos, proto_height, proto_width = protos.shape
+    mask_logits = predictions[:, 4 + num_classes:] @ protos.reshape(num_protos, -1)
+    mask_logits = mask_logits.reshape(-1, proto_height, proto_width)
+    ratio_y, ratio_x = proto_height / INPUT_HEIGHT, proto_width / INPUT_WIDTH
+    mask_logits = mask_logits[
+        :,
+        round(top * ratio_y):round((top + height * scale) * ratio_y),
+        round(left * ratio_x):round((left + width * scale) * ratio_x),
+    ]
+
+    # Bilinearly sample each mask's logits at original image resolution, but
+    # only inside its box: the same sampling as resizing the whole mask to
+    # the image and cropping it, without the full-size intermediate
+    logits_height, logits_width = mask_logits.shape[1:]
+    step_x, step_y = logits_width / width, logits_height / height
+    boxes = xyxy.round().astype(int)
+    box_masks = []
+    for logits, (x1, y1, x2, y2) in zip(mask_logits, boxes):
+        if x2 <= x1 or y2 <= y1:
+            box_masks.append(np.zeros((max(y2 - y1, 0), max(x2 - x1, 0)), dtype=bool))
+            continue
+        to_logits = np.array([
+            [step_x, 0, (x1 + 0.5) * step_x - 0.5],
+            [0, step_y, (y1 + 0.5) * step_y - 0.5],
+        ])
+        box_logits = cv2.warpAffine(
+            logits, to_logits, (int(x2 - x1), int(y2 - y1)),
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE,
+        )
+        box_masks.append(box_logits > 0)
+
+    keep = mask_nms(box_masks, boxes, class_ids)
+    xyxy, class_ids, confidences, boxes = xyxy[keep], class_ids[keep], confidences[keep], boxes[keep]
+    box_masks = [box_masks[i] for i in keep]
+
+    masks = np.zeros((len(keep), height, width), dtype=bool) if full_masks else None
+    polygons = []
+    for i, (box_mask, (x1, y1, x2, y2)) in enumerate(zip(box_masks, boxes)):
+        polygons.append(mask_polygon(box_mask, (int(x1), int(y1))) if box_mask.size else [])
+        if full_masks:
+            masks[i, y1:y2, x1:x2] = box_mask
+
+    return sv.Detections(
+        xyxy=xyxy,
+        mask=masks,
+        confidence=confidences,
+        class_id=class_ids,
+        data={"polygon": polygons},
+    )
+
+
+# Batch size -> (IO binding, bound input, host input buffer), created on
+# first use. Only the inference worker thread touches these.
+io_bindings = {}
+inference_queue = queue.Queue()
+
+
+def run_batch(canvases):
+    """
+    Run one model call on a list of letterboxed (H, W, 3) uint8 canvases.
+
+    Returns a (predictions, protos) pair per canvas. protos is None for images
+    where no anchor clears the confidence threshold, since their mask
+    prototypes are never needed.
+    """
+    batch_size = len(canvases)
+    if batch_size not in io_bindings:
+        host_buffer = np.empty((batch_size, 3, INPUT_HEIGHT, INPUT_WIDTH), dtype=np.float32)
+        if DEVICE_TYPE == "cpu":
+            # Wraps host_buffer without copying, so filling it is all it takes
+            input_value = ort.OrtValue.ortvalue_from_numpy(host_buffer)
+        else:
+            input_value = ort.OrtValue.ortvalue_from_shape_and_type(
+                host_buffer.shape, np.float32, DEVICE_TYPE, 0
+            )
+        io_binding = session.io_binding()
+        io_binding.bind_ortvalue_input(INPUT_NAME, input_value)
+        for output_name in OUTPUT_NAMES:
+            io_binding.bind_output(output_name, DEVICE_TYPE, 0)
+        io_bindings[batch_size] = (io_binding, input_value, host_buffer)
+
+    io_binding, input_value, host_buffer = io_bindings[batch_size]
+    # BGR HWC uint8 -> RGB CHW float32 in [0, 1], written in place
+    for canvas, slot in zip(canvases, host_buffer):
+        np.divide(canvas[..., ::-1].transpose(2, 0, 1), np.float32(255.0), out=slot, dtype=np.float32)
+    if DEVICE_TYPE != "cpu":
+        input_value.update_inplace(host_buffer)
+    session.run_with_iobinding(io_binding)
+
+    # Copy out of the bound buffers, which the next call with this batch size overwrites
+    predictions_value, protos_value = io_binding.get_outputs()
+    predictions = np.array(predictions_value.numpy())
+    has_candidates = predictions[:, 4:4 + len(CLASS_NAMES)].max(axis=(1, 2)) >= CONFIDENCE_THRESHOLD
+    protos = np.array(protos_value.numpy()) if has_candidates.any() else None
+
+    return [
+        (predictions[i], protos[i] if has_candidates[i] else None)
+        for i in range(batch_size)
+    ]
+
+
+def inference_worker():
+    """
+    Owns the model: collects queued (canvas, future) requests into batches of
+    up to MAX_BATCH_SIZE, waiting at most BATCH_WAIT_MS for the batch to
+    fill, and resolves each future with its slice of the outputs.
+    Runs the blank warm-up image when idle for KEEPALIVE_SECONDS.
+    """
+    import time
+
+    while True:
+        try:
+            batch = [inference_queue.get(timeout=KEEPALIVE_SECONDS or None)]
+        except queue.Empty:
+            try:
+                run_batch([WARMUP_CANVAS])
+            except Exception as e:
+                print(f"Keep-alive inference failed: {e}")
+            continue
+        deadline = time.monotonic() + BATCH_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(inference_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        canvases, futures = zip(*batch)
+        try:
+            outputs = run_batch(canvases)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            continue
+        for future, output in zip(futures, outputs):
+            future.set_result(output)
+
+
+# Warm up before the worker starts, while this thread still owns the model.
+# Every other batch size runs once too, so per-shape setup (cuDNN algorithm
+# search, IO bindings) doesn't land on the first batch of that size.
+WARMUP_CANVAS = np.full((INPUT_HEIGHT, INPUT_WIDTH, 3), 114, dtype=np.uint8)
+for _ in range(WARMUP_RUNS):
+    run_batch([WARMUP_CANVAS])
+for batch_size in range(2, MAX_BATCH_SIZE + 1):
+    run_batch([WARMUP_CANVAS] * batch_size)
+print(f"Model warmed up ({WARMUP_RUNS} runs, up to batch size {MAX_BATCH_SIZE})")
+
+threading.Thread(target=inference_worker, name="inference-worker", daemon=True).start()
+
+
+def segment(image, full_masks=False):
+    """
+    Run the segmentation model on a BGR image.
+
+    Returns the detections and a timing breakdown (ms) of the model stages.
+    The inference time includes waiting for the batch to fill. full_masks is
+    passed on to postprocess. Raises FutureTimeoutError if the result doesn't
+    arrive within INFERENCE_TIMEOUT_SECONDS.
+    """
+    import time
+
+    start = time.time()
+    canvas, scale, padding = preprocess(image)
+    preprocessed = time.time()
+    future = Future()
+    inference_queue.put((canvas, future))
+    predictions, protos = future.result(timeout=INFERENCE_TIMEOUT_SECONDS)
+    inferred = time.time()
+    if protos is not None:
+        detections = postprocess(predictions, protos, scale, padding, image.shape, full_masks)
+    else:
+        detections = sv.Detections.empty()
+    finished = time.time()
+
+    speed = {
+        "preprocess": (preprocessed - start) * 1000,
+        "inference": (inferred - preprocessed) * 1000,
+        "postprocess": (finished - inferred) * 1000,
+    }
+    return detections, speed
+
+
+def draw_masks(scene, detections):
+    """
+    Blend all detection masks onto the scene in place with a single addWeighted.
+
+    Masks are empty outside their boxes, so each one is only read inside its
+    box and the blend only covers the area spanned by the detections.
+    """
+    if len(detections) == 0:
+        return scene
+
+    boxes = detections.xyxy.round().astype(int)
+    left, top = boxes[:, :2].min(axis=0)
+    right, bottom = boxes[:, 2:].max(axis=0)
+
+    # 1-based index of the detection shown at each pixel (0 = background).
+    # Drawn in reverse so the most confident detection ends up on top.
+    owner = np.zeros((bottom - top, right - left), dtype=np.uint16)
+    for index in range(len(detections), 0, -1):
+        x1, y1, x2, y2 = boxes[index - 1]
+        box_mask = detections.mask[index - 1, y1:y2, x1:x2]
+        owner[y1 - top:y2 - top, x1 - left:x2 - left][box_mask] = index
+
+    colors = np.vstack([np.zeros((1, 3), dtype=np.uint8), MASK_COLORS[detections.class_id]])
+    region = scene[top:bottom, left:right]
+    blended = cv2.addWeighted(region, 1 - MASK_OPACITY, colors[owner], MASK_OPACITY, 0)
+    np.copyto(region, blended, where=(owner > 0)[..., np.newaxis])
+    return scene
+
+
+def shrink_to_preview(frame):
+    """
+    Shrink a frame so its long side is at most PREVIEW_MAX_SIZE.
+
+    Returns the preview and the scale factor applied to the frame.
+    """
+    height, width = frame.shape[:2]
+    scale = min(1.0, PREVIEW_MAX_SIZE / max(height, width))
+    if scale < 1:
+        frame = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    return frame, scale
+
+
+def encode_preview(frame):
+    """Encode a preview frame as a base64 JPEG."""
+    _, buffer = cv2.imencode(
+        ".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    )
+    return base64.b64encode(buffer).decode("utf-8")
+
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    return jsonify({"error": f"Image exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB upload limit"}), 413
+
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -127,7 +694,9 @@ def health():
 def detect():
     """
     Accepts a multipart image upload (field name: "image").
-    Returns JSON with timing, thresholds, and detection results.
+    Returns JSON with timing, thresholds, and detection results, including a
+    box and mask outline per tile for the client to draw.
+    With ?render=1 the response also carries an annotated preview JPEG.
     """
     import time
     
@@ -136,13 +705,11 @@ def detect():
     if "image" not in request.files:
         return jsonify({"error": "No image file provided"}), 400
 
-    file = request.files["image"]
-    image_bytes = file.read()
+    image_bytes = read_upload(request.files["image"])
 
     # ──── PREPROCESS ────
     preprocess_start = time.time()
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    image = decode_image(image_bytes)
 
     if image is None:
         return jsonify({"error": "Could not decode image"}), 400
@@ -151,60 +718,60 @@ def detect():
 
     # ──── INFERENCE ────
     inference_start = time.time()
-    results = model(image)
-    detections = sv.Detections.from_ultralytics(results[0])
+    render = request.args.get("render") == "1"
+    try:
+        detections, model_speed = segment(image, full_masks=render)
+    except FutureTimeoutError:
+        return jsonify({"error": "Inference timed out"}), 503
     inference_time_ms = round((time.time() - inference_start) * 1000)
     
-    # Extract YOLO's internal timing from results
-    yolo_speed = results[0].speed  # dict with keys: 'preprocess', 'inference', 'postprocess' (in ms)
+    # Per-stage timing of the model pipeline (letterbox, session.run, decode + NMS)
     yolo_timing = {
-        "preprocess_ms": round(yolo_speed['preprocess']),
-        "inference_ms": round(yolo_speed['inference']),
-        "postprocess_ms": round(yolo_speed['postprocess']),
+        "preprocess_ms": round(model_speed['preprocess']),
+        "inference_ms": round(model_speed['inference']),
+        "postprocess_ms": round(model_speed['postprocess']),
     }
 
     # ──── POSTPROCESS ────
     postprocess_start = time.time()
-    
-    # Apply Non-Maximum Suppression
-    detections = detections.with_nms(threshold=NMS_THRESHOLD)
-
-    # Filter low-confidence detections
-    if CONFIDENCE_THRESHOLD > 0:
-        detections = detections[detections.confidence >= CONFIDENCE_THRESHOLD]
-
-    # Extract detected letters
-    letter_list = []
-    letters = ""
-    for class_id, confidence in zip(detections.class_id, detections.confidence):
-        class_name = model.names[class_id]
-        letter = CLASS_NAME_TO_LETTER.get(class_name, class_name)
-        letter_list.append({"letter": letter, "confidence": round(float(confidence), 3)})
-        letters += letter
 
     # Sort by confidence descending
-    letter_list.sort(key=lambda x: x["confidence"], reverse=True)
-
-    # Create annotated image with segmentation masks and labels
-    mask_annotator = sv.MaskAnnotator()
-    label_annotator = sv.LabelAnnotator(
-        text_position=sv.Position.BOTTOM_CENTER,
-        text_scale=1,
-        text_thickness=1,
-    )
+    detections = detections[np.argsort(-detections.confidence, kind="stable")]
 
-    labels = [
-        f"{CLASS_NAME_TO_LABEL.get(model.names[class_id], model.names[class_id])} {confidence:.2f}"
-        for class_id, confidence in zip(detections.class_id, detections.confidence)
+    # Extract detected letters with their boxes and mask outlines (image pixels)
+    detected_letters = LETTER_BY_ID[detections.class_id]
+    letter_list = [
+        {"letter": letter, "confidence": confidence, "box": box, "polygon": polygon}
+        for letter, confidence, box, polygon in zip(
+            detected_letters.tolist(),
+            detections.confidence.astype(float).round(3).tolist(),
+            detections.xyxy.round().astype(int).tolist(),
+            detections.data.get("polygon", []),
+        )
     ]
+    letters = "".join(detected_letters)
 
-    annotated_frame = image.copy()
-    annotated_frame = mask_annotator.annotate(scene=annotated_frame, detections=detections)
-    annotated_frame = label_annotator.annotate(scene=annotated_frame, detections=detections, labels=labels)
+    # Annotated preview, only on request (debugging / legacy clients)
+    annotated_b64 = None
+    if render:
+        # Masks are blended at full resolution straight onto the decoded
+        # image (the original isn't needed afterwards), labels are drawn
+        # once on the downscaled preview
+        labels = [
+            f"{label} {confidence:.2f}"
+            for label, confidence in zip(LABEL_BY_ID[detections.class_id], detections.confidence)
+        ]
+
+        annotated_frame = draw_masks(image, detections)
+        preview, preview_scale = shrink_to_preview(annotated_frame)
+        preview_detections = sv.Detections(
+            xyxy=detections.xyxy * preview_scale,
+            confidence=detections.confidence,
+            class_id=detections.class_id,
+        )
+        preview = LABEL_ANNOTATOR.annotate(scene=preview, detections=preview_detections, labels=labels)
 
-    # Encode annotated image to base64 JPEG
-    _, buffer = cv2.imencode(".jpg", annotated_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-    annotated_b64 = base64.b64encode(buffer).decode("utf-8")
+        annotated_b64 = encode_preview(preview)
     
     postprocess_time_ms = round((time.time() - postprocess_start) * 1000)
     total_time_ms = round((time.time() - total_start) * 1000)
@@ -217,6 +784,7 @@ def detect():
             "letters": letters,
             "letter_list": letter_list,
             "annotated_image": annotated_b64,
+            "image_size": {"width": image.shape[1], "height": image.shape[0]},
             "count": len(letter_list),
             "timing": {
                 "preprocess_ms": preprocess_time_ms,
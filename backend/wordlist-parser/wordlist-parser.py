@@ -1,6 +1,7 @@
 import time
-import csv
-from typing import List, Tuple, Optional
+
+import numpy as np
+import pandas as pd
 
 
 # ============================================================================
@@ -24,24 +25,67 @@ BANANAGRAMS_TILE_DISTRIBUTION = {
     'v': 4, 'y': 2, 'ä': 7, 'ö': 1
 }
 
-ALLOWED_CHARS = set(BANANAGRAMS_TILE_DISTRIBUTION.keys())
+TILE_LETTERS = list(BANANAGRAMS_TILE_DISTRIBUTION.keys())
+TILE_LIMITS = np.array(list(BANANAGRAMS_TILE_DISTRIBUTION.values()))
+
+# Code point -> tile index (0-21) lookup for the vectorized checks.
+# NUL pads shorter words in fixed-width arrays and gets its own index;
+# every other character maps to INVALID_INDEX.
+PADDING_INDEX = len(TILE_LETTERS)
+INVALID_INDEX = PADDING_INDEX + 1
+CODEPOINT_TO_TILE = np.full(256, INVALID_INDEX)
+CODEPOINT_TO_TILE[0] = PADDING_INDEX
+for tile_index, letter in enumerate(TILE_LETTERS):
+    CODEPOINT_TO_TILE[ord(letter)] = tile_index
+
+# Buffer size for reading the word list and writing the output
+IO_BUFFER_SIZE = 1 << 20
+WRITE_CHUNK_WORDS = 10_000
+
+# Particle word classes, rejected unless allowed below
+PARTICLE_MARKERS = ('adverbi', 'prepositio', 'postpositio', 'konjunktio', 'interjektio')
+
+# Rejected inflection codes:
+# 100 = misspelled (correct spelling in dictionary article)
+# 101 = pronoun with irregular inflection
+REJECTED_INFLECTIONS = frozenset({'100', '101'})
+
+# Columns of the Nykysuomen sanalista (Hakusana, Homonymia, Sanaluokka, Taivutustiedot)
+COLUMNS = ['word', 'homonym', 'category', 'inflection']
 
 
 # ============================================================================
 # WORD VALIDATION
 # ============================================================================
 
-def containsOnlyAllowedChars(word: str) -> bool:
-    """Check if word contains only Finnish Bananagrams characters."""
-    return all(char in ALLOWED_CHARS for char in word)
-
-
-def fitsTileDistribution(word: str) -> bool:
-    """Check if word can be made with available Bananagrams tiles."""
-    for char in set(word):
-        if word.count(char) > BANANAGRAMS_TILE_DISTRIBUTION[char]:
-            return False
-    return True
+def validWordMask(words: pd.Series) -> np.ndarray:
+    """
+    Vectorized spelling checks for Bananagrams use.
+    
+    Args:
+        words: The words to validate
+        
+    Returns:
+        Boolean array, True where the word contains only Finnish Bananagrams
+        characters and can be made with the available tiles
+    """
+    # Fixed-width UTF-32 array viewed as one row of code points per word
+    chars = words.to_numpy(dtype=str)
+    codepoints = chars.view(np.uint32).reshape(len(chars), chars.itemsize // 4)
+    tiles = CODEPOINT_TO_TILE[np.minimum(codepoints, len(CODEPOINT_TO_TILE) - 1)]
+    tiles[codepoints >= len(CODEPOINT_TO_TILE)] = INVALID_INDEX
+    
+    # Only tile letters are allowed, which also skips words with hyphens
+    # (compound words like "rekka-auto")
+    # TODO: Could allow these if we strip hyphens when it's just vowel collision
+    allowed = (tiles != INVALID_INDEX).all(axis=1)
+    
+    # (words x tiles) count matrix in one bincount, compared against the distribution
+    bins = INVALID_INDEX + 1
+    row_offsets = np.arange(len(tiles))[:, np.newaxis] * bins
+    counts = np.bincount((tiles + row_offsets).ravel(), minlength=len(tiles) * bins)
+    counts = counts.reshape(len(tiles), bins)[:, :len(TILE_LETTERS)]
+    return allowed & (counts <= TILE_LIMITS).all(axis=1)
 
 
 def isValidCategory(category: str, inflection: str) -> bool:
@@ -57,8 +101,7 @@ def isValidCategory(category: str, inflection: str) -> bool:
     """
     # Reject particles (adverbs, prepositions, conjunctions, interjections when used as particles)
     # except when they have special conjugation that makes them standalone words
-    particle_markers = ['adverbi', 'prepositio', 'postpositio', 'konjunktio', 'interjektio']
-    if any(marker in category for marker in particle_markers):
+    if any(marker in category for marker in PARTICLE_MARKERS):
         # Check combined forms like "adverbi + kieltoverbi"
         if '+' in category or 'kieltoverbi' in category:
             return False
@@ -76,10 +119,8 @@ def isValidCategory(category: str, inflection: str) -> bool:
     if category == 'numeraali':
         return ACCEPT_NUMERALS
     
-    # Reject words with special inflection codes:
-    # 100 = misspelled (correct spelling in dictionary article)
-    # 101 = pronoun with irregular inflection
-    if inflection in ['100', '101']:
+    # Reject words with special inflection codes (misspellings, irregular pronouns)
+    if inflection in REJECTED_INFLECTIONS:
         return False
     
     # Check main word categories
@@ -100,59 +141,42 @@ def isValidCategory(category: str, inflection: str) -> bool:
     return False
 
 
-def isWordValid(word: str, category: str, inflection: str) -> bool:
+def validCategoryMask(categories: pd.Series, inflections: pd.Series) -> np.ndarray:
     """
-    Comprehensive validation of a word for Bananagrams use.
+    Evaluate isValidCategory for every row.
     
-    Args:
-        word: The word to validate
-        category: Sanaluokka (word class)
-        inflection: Taivutustiedot (inflection info)
-        
-    Returns:
-        True if word passes all validation checks
+    The word list only has a few hundred distinct (category, inflection)
+    pairs, so each pair is checked once and the result mapped back to rows.
     """
-    # Skip words with hyphens (compound words like "rekka-auto")
-    # TODO: Could allow these if we strip hyphens when it's just vowel collision
-    if '-' in word:
-        return False
-    
-    # Check character validity
-    if not containsOnlyAllowedChars(word):
-        return False
+    # A MultiIndex can't be built from zero rows
+    if len(categories) == 0:
+        return np.zeros(0, dtype=bool)
     
-    # Check tile distribution
-    if not fitsTileDistribution(word):
-        return False
-    
-    # Check category validity
-    if not isValidCategory(category, inflection):
-        return False
-    
-    return True
+    codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([categories, inflections]))
+    valid = np.array([isValidCategory(category, inflection) for category, inflection in pairs], dtype=bool)
+    return valid[codes]
 
 
 # ============================================================================
 # HOMONYM HANDLING
 # ============================================================================
 
-def processHomonymGroup(homonym_rows: List[Tuple[str, str, str, str]]) -> Optional[str]:
+def homonymGroupStarts(words: pd.Series, is_homonym: pd.Series) -> np.ndarray:
     """
-    Process a group of homonymous words and return the word if any variant is valid.
+    Mark the first row of every homonym group.
     
-    Homonyms are words that are spelled the same but have different meanings/categories.
-    If ANY of the homonym variants is in an accepted category, we include the word.
+    Homonyms are words that are spelled the same but have different
+    meanings/categories. Consecutive homonym rows of the same word form one
+    group; every other row is a group of its own.
     
-    Args:
-        homonym_rows: List of (word, homonym_num, category, inflection) tuples
-        
     Returns:
-        The word in lowercase if valid, None otherwise
+        Boolean array, True where a new group starts
     """
-    for word, _, category, inflection in homonym_rows:
-        if isValidCategory(category, inflection):
-            return word.lower()
-    return None
+    return (
+        ~is_homonym
+        | ~is_homonym.shift(fill_value=False)
+        | (words != words.shift())
+    ).to_numpy()
 
 
 # ============================================================================
@@ -170,71 +194,44 @@ def parseDictionary(input_file: str, output_file: str) -> None:
     start_time = time.time()
     print(f'Starting to parse {input_file}...')
     
-    words_written = 0
-    words_processed = 0
-    homonym_buffer: List[Tuple[str, str, str, str]] = []
-    last_word = None
-    
     try:
-        with open(input_file, 'r', encoding='utf-8') as csvfile:
-            reader = csv.reader(csvfile, delimiter='\t')
-            
-            # Skip header row
-            next(reader)
-            
-            with open(output_file, 'w', encoding='utf-8') as wordlist:
-                for row in reader:
-                    words_processed += 1
-                    
-                    # Handle rows with missing columns (pad with empty strings)
-                    while len(row) < 4:
-                        row.append('')
-                    
-                    word = row[0].strip()
-                    homonym_num = row[1].strip()
-                    category = row[2].strip()
-                    inflection = row[3].strip()
-                    
-                    # Skip empty rows
-                    if not word:
-                        continue
-                    
-                    # Handle homonyms
-                    if homonym_num:
-                        # If we're starting a new homonym group, process the previous one
-                        if homonym_buffer and word != last_word:
-                            result = processHomonymGroup(homonym_buffer)
-                            if result:
-                                wordlist.write(f'{result}\n')
-                                words_written += 1
-                            homonym_buffer = []
-                        
-                        # Add to current homonym group
-                        homonym_buffer.append((word, homonym_num, category, inflection))
-                        last_word = word
-                        continue
-                    
-                    # Process any pending homonym group
-                    if homonym_buffer:
-                        result = processHomonymGroup(homonym_buffer)
-                        if result:
-                            wordlist.write(f'{result}\n')
-                            words_written += 1
-                        homonym_buffer = []
-                    
-                    # Process regular word
-                    if isWordValid(word, category, inflection):
-                        wordlist.write(f'{word.lower()}\n')
-                        words_written += 1
-                    
-                    last_word = word
-                
-                # Process final homonym group if any
-                if homonym_buffer:
-                    result = processHomonymGroup(homonym_buffer)
-                    if result:
-                        wordlist.write(f'{result}\n')
-                        words_written += 1
+        # Read the raw bytes in large chunks and let pandas decode the UTF-8.
+        # Fields past the fourth column are ignored.
+        with open(input_file, 'rb', buffering=IO_BUFFER_SIZE) as csvfile:
+            df = pd.read_csv(
+                csvfile, sep='\t', header=0, names=COLUMNS, usecols=range(len(COLUMNS)),
+                dtype=str, keep_default_na=False, encoding='utf-8',
+            )
+        words_processed = len(df)
+        
+        # Rows with missing columns are padded with empty strings. The
+        # delimiters already separate the fields, so only the word itself is
+        # stripped in case of stray whitespace.
+        df = df.fillna('')
+        df['word'] = df['word'].str.strip()
+        
+        # Skip empty rows
+        df = df[df['word'] != ''].reset_index(drop=True)
+        
+        is_homonym = df['homonym'] != ''
+        category_ok = validCategoryMask(df['category'], df['inflection'])
+        
+        # Homonyms: include the word if ANY variant is in an accepted category
+        group_starts = homonymGroupStarts(df['word'], is_homonym)
+        homonym_ok = pd.Series(category_ok).groupby(group_starts.cumsum()).transform('any').to_numpy()
+        
+        # Regular words must also pass the spelling checks
+        word_ok = category_ok & validWordMask(df['word'])
+        
+        keep = group_starts & np.where(is_homonym.to_numpy(), homonym_ok, word_ok)
+        words = df['word'][keep].str.lower().tolist()
+        
+        # Write in large joined chunks instead of one call per word
+        with open(output_file, 'w', encoding='utf-8', buffering=IO_BUFFER_SIZE) as wordlist:
+            for start in range(0, len(words), WRITE_CHUNK_WORDS):
+                chunk = words[start:start + WRITE_CHUNK_WORDS]
+                wordlist.write('\n'.join(chunk) + '\n')
+        words_written = len(words)
         
         end_time = time.time()
         duration = end_time - start_time